@@ -1,8 +1,15 @@
 """ Config """
+import os
+import pickle
 from typing import NamedTuple, Dict
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
 
 class Config:
     class ConfigError(Exception):
@@ -16,8 +23,7 @@ class Config:
     devices: Dict[str, DeviceConfig]
 
     def __init__(self, file_path: str):
-        with open(file_path) as f:
-            self.data = yaml.safe_load(f)
+        self.data = self._load(file_path)
 
         if 'devices' not in self.data:
             raise self.ConfigError('No devices section')
@@ -25,3 +31,27 @@ class Config:
         self.devices = {}
         for k, v in self.data['devices'].items():
             self.devices[k] = self.DeviceConfig(**v)
+
+    @staticmethod
+    def _load(file_path: str):
+        """ Load yaml, cached as pickle keyed by the yaml mtime """
+        cache_path = f'{file_path}.pkl'
+        mtime = os.stat(file_path).st_mtime_ns
+        # noinspection PyBroadException
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_mtime, data = pickle.load(f)
+            if cached_mtime == mtime:
+                return data
+        except Exception:
+            pass
+
+        with open(file_path) as f:
+            data = yaml.load(f, Loader=Loader)
+
+        try:
+            with open(cache_path, 'wb') as f:
+                pickle.dump((mtime, data), f)
+        except OSError:
+            pass
+        return data
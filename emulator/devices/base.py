@@ -1,32 +1,81 @@
 """ Basic device classes """
 
+import atexit
 import logging
 import os
+import random
 import struct
+import time
 from contextlib import contextmanager
 from datetime import datetime
+from itertools import groupby
 import sqlite3
-from typing import Union, Optional, Tuple
+from typing import Union, Optional, Tuple, List
 from urllib.parse import urlparse
+from urllib.request import pathname2url
 
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, abort, Response, request
-from gevent import sleep, socket
+from gevent import sleep, socket, spawn
+from gevent.event import AsyncResult
 from gevent.lock import BoundedSemaphore
+from gevent.queue import Queue, Empty
 from gevent.pool import Pool
 from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPool
 
 log = logging.getLogger('emulator.devices.device')
 TValue = Union[str, int, float]
 
+# WAL lets readers run alongside the writer, NORMAL sync skips the
+# per-commit fsync of the main database file
+DB_PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-8000',
+    'busy_timeout=5000',
+)
+
+# Custom event protocol reply framing:
+# <magic:4><count:4>, per event <id:8><ts:8><len:4><value>, then a zero byte
+PROTO_MAGIC = 0xDEADBEEF
+_REPLY_HEADER = struct.Struct('>II')
+_EVENT_HEADER = struct.Struct('>QQI')
+_INT_VALUE = struct.Struct('>q')
+_FLOAT_VALUE = struct.Struct('>d')
+
+# Hot statements, kept as constants so sqlite's statement cache reuses them
+SQL_SET_SUBSCRIPTION = """
+    INSERT OR REPLACE INTO subscription (id, callback_url) VALUES (1, ?)
+"""
+SQL_INSERT_SENT_EVENT = """INSERT INTO sent_events (ts, value) VALUES (?, ?)"""
+SQL_UPDATE_SENT_AT = """UPDATE sent_events SET sent_at = ? WHERE id = ?"""
+SQL_INSERT_EVENT = """INSERT INTO events (ts, value) VALUES (?, ?)"""
+SQL_SELECT_EVENTS = """
+    SELECT id, ts, value FROM events
+    WHERE ts >= ? ORDER BY ts
+"""
+
 
 class Device:
     class EventError(Exception):
         pass
 
+    # Queued inserts are flushed every WRITE_BATCH_SIZE rows or
+    # WRITE_BATCH_DELAY seconds, whichever comes first
+    WRITE_BATCH_SIZE = 500
+    WRITE_BATCH_DELAY = 0.02
+    # Read-only connections used by read_cursor()
+    READERS_COUNT = 4
+    # OS threads running sqlite calls, so they don't block the gevent hub
+    DB_THREADS = 4
+
     def __init__(self, path: str, name: str, host: str, port: int):
         """ Constructor """
         self._name = name
+        self.name = f'[DEV {name}]'
         self.host = host
         self.port = port
         self.datadir = os.path.join(path, 'data')
@@ -34,11 +83,24 @@ class Device:
             os.mkdir(self.datadir)
         db_path = os.path.join(self.datadir, f'device_{self._name}.sqlite3')
         self.lock_db = BoundedSemaphore(1)
-        self.db = sqlite3.connect(db_path)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            self.db.execute(f'PRAGMA {pragma}')
+
+        self._readers = Queue()
+        for _ in range(self.READERS_COUNT):
+            reader = sqlite3.connect(
+                f'file:{pathname2url(db_path)}?mode=ro',
+                uri=True,
+                check_same_thread=False,
+            )
+            reader.execute('PRAGMA busy_timeout=5000')
+            self._readers.put(reader)
 
-    @property
-    def name(self):
-        return f'[DEV {self._name}]'
+        self._db_pool = ThreadPool(self.DB_THREADS)
+        self._write_q = Queue()
+        self._flusher_greenlet = spawn(self._flusher)
+        atexit.register(self.close)
 
     @contextmanager
     def cursor(self):
@@ -61,6 +123,101 @@ class Device:
             except Exception:
                 pass
 
+    @contextmanager
+    def read_cursor(self):
+        """ Cursor on a pooled read-only connection, no database lock """
+        reader = self._readers.get()
+        cursor = reader.cursor()
+        try:
+            yield cursor
+        finally:
+            # noinspection PyBroadException
+            try:
+                cursor.close()
+            except Exception:
+                pass
+            self._readers.put(reader)
+
+    def _read(self, sql: str, params: tuple) -> list:
+        """ Run a query on a reader connection in the DB thread pool """
+        with self.read_cursor() as c:
+            return self._db_pool.apply(
+                lambda: c.execute(sql, params).fetchall())
+
+    def close(self):
+        """ Close database connections """
+        atexit.unregister(self.close)
+        # noinspection PyBroadException
+        try:
+            self.db.execute('PRAGMA optimize')
+        except Exception:
+            log.exception('%s Error optimizing database', self.name)
+        while not self._readers.empty():
+            self._readers.get().close()
+        self.db.close()
+        self._db_pool.kill()
+
+    def _write(self, sql: str, params: tuple) -> AsyncResult:
+        """ Queue a statement for the batch writer """
+        result = AsyncResult()
+        self._write_q.put((sql, params, result))
+        return result
+
+    def _insert(self, sql: str, params: tuple) -> int:
+        """ Queue an insert for the batch writer and wait for its row id """
+        return self._write(sql, params).get()
+
+    def _flusher(self):
+        """ Batch writer loop """
+        while True:
+            batch = [self._write_q.get()]
+            deadline = time.monotonic() + self.WRITE_BATCH_DELAY
+            while len(batch) < self.WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._write_q.get(timeout=timeout))
+                except Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[str, tuple, AsyncResult]]):
+        """ Write a batch of statements in one transaction """
+        statements = [(sql, params) for sql, params, _ in batch]
+        try:
+            with self.lock_db:
+                row_ids = self._db_pool.apply(self._write_batch, (statements,))
+        except Exception as err:
+            log.exception('%s Error writing events batch', self.name)
+            for _, _, result in batch:
+                result.set_exception(err)
+            return
+
+        for (_, _, result), row_id in zip(batch, row_ids):
+            result.set(row_id)
+
+    def _write_batch(self, statements: List[Tuple[str, tuple]]) -> List[int]:
+        """ Run statements in one transaction, called in the DB thread pool """
+        row_ids = []
+        c = self.db.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            for sql, items in groupby(statements, key=lambda x: x[0]):
+                params = [item[1] for item in items]
+                c.executemany(sql, params)
+                # lastrowid isn't set by executemany
+                c.execute('SELECT last_insert_rowid()')
+                last_id = c.fetchone()[0]
+                row_ids.extend(range(last_id - len(params) + 1, last_id + 1))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            c.close()
+        return row_ids
+
     def run(self):
         """ Run """
         raise NotImplementedError()
@@ -77,28 +234,99 @@ class Device:
 class WebhookDevice(Device):
     server: WSGIServer
 
+    # Callback request (connect, read) timeouts
+    CALLBACK_TIMEOUT = (3, 10)
+    # Retry delay doubles from RETRY_DELAY_BASE up to RETRY_DELAY_MAX seconds,
+    # plus up to 50% jitter so failing devices don't retry in lockstep
+    RETRY_DELAY_BASE = 1.0
+    RETRY_DELAY_MAX = 30.0
+    # Max concurrent HTTP requests
+    HTTP_POOL_SIZE = 200
+
     def __init__(self, path: str, name: str, host: str, port: int):
         super().__init__(path, name, host, port)
 
+        # Keep-alive connections to the callback host
+        self._session = requests.Session()
+        self._session.headers['Connection'] = 'keep-alive'
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
         with self.cursor() as c:
+            old_callback = self._drop_old_subscription(c)
             c.execute("""
-                CREATE TABLE IF NOT EXISTS subscription 
-                (callback_url VARCHAR(255))
+                CREATE TABLE IF NOT EXISTS subscription (
+                    id integer primary key CHECK (id = 1),
+                    callback_url text NOT NULL
+                )
             """)
+            if old_callback is not None:
+                c.execute(SQL_SET_SUBSCRIPTION, (old_callback,))
             c.execute("""
-                CREATE TABLE IF NOT EXISTS event_id 
-                (id int integer)
+                CREATE TABLE IF NOT EXISTS sent_events (
+                    id integer primary key AUTOINCREMENT,
+                    ts integer,
+                    value text,
+                    sent_at integer
+                )
             """)
+            self._migrate_event_id(c)
             res = c.execute("""SELECT callback_url FROM subscription""")
             row = res.fetchone()
             if row:
                 self.callback_url = row[0]
-                log.info(
-                    f'{self.name} Loaded callback URL "{self.callback_url}"')
+                log.info('%s Loaded callback URL "%s"',
+                         self.name, self.callback_url)
             else:
                 self.callback_url = None
 
-    def run(self):
+        self.server = WSGIServer(
+            (self.host, self.port),
+            self._make_app(),
+            spawn=Pool(self.HTTP_POOL_SIZE),
+        )
+
+    @staticmethod
+    def _drop_old_subscription(c: sqlite3.Cursor) -> Optional[str]:
+        """ Drop the old id-less subscription table, return its callback """
+        res = c.execute("""PRAGMA table_info(subscription)""")
+        columns = [row[1] for row in res.fetchall()]
+        if not columns or 'id' in columns:
+            return None
+        res = c.execute("""SELECT callback_url FROM subscription""")
+        row = res.fetchone()
+        c.execute("""DROP TABLE subscription""")
+        return row[0] if row else None
+
+    @staticmethod
+    def _migrate_event_id(c: sqlite3.Cursor):
+        """ Continue ids from the old event_id counter table """
+        res = c.execute("""
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = 'event_id'
+        """)
+        if res.fetchone() is None:
+            return
+        res = c.execute("""SELECT MAX(id) FROM event_id""")
+        old_max = res.fetchone()[0]
+        res = c.execute("""
+            SELECT 1 FROM sqlite_sequence WHERE name = 'sent_events'
+        """)
+        if old_max and res.fetchone() is None:
+            c.execute(
+                """INSERT INTO sqlite_sequence VALUES ('sent_events', ?)""",
+                (old_max,),
+            )
+        c.execute("""DROP TABLE event_id""")
+
+    def close(self):
+        """ Close """
+        self._session.close()
+        super().close()
+
+    def _make_app(self) -> Flask:
+        """ Build the subscription HTTP app """
         app = Flask('device_{}'.format(self.name))
 
         @app.route('/subscribe', methods=['GET'])
@@ -116,30 +344,31 @@ class WebhookDevice(Device):
                     raise Exception('No host')
             except Exception as err:
                 message = f'Wrong callback format: {err}'
-                log.warning('{} Subscribe call from {}: {}'.format(
-                    log.name,
+                log.warning(
+                    '%s Subscribe call from %s: %s',
+                    self.name,
                     request.remote_addr,
                     message,
-                ))
+                )
                 abort(Response(message, 400))
 
             with self.cursor() as c:
-                c.execute("""DELETE FROM subscription WHERE 1""")
-                c.execute(
-                    """INSERT INTO subscription VALUES (?)""",
-                    (callback,),
-                )
+                c.execute(SQL_SET_SUBSCRIPTION, (callback,))
             self.callback_url = callback
-            log.info('{} Subscribe call from {}: subscribed to {}'.format(
+            log.info(
+                '%s Subscribe call from %s: subscribed to %s',
                 self.name,
                 request.remote_addr,
                 self.callback_url,
-            ))
+            )
 
             return 'OK'
 
-        self.server = WSGIServer((self.host, self.port), app)
-        log.info(f'{self.name} Listening for HTTP on {self.host}:{self.port}')
+        return app
+
+    def run(self):
+        log.info('%s Listening for HTTP on %s:%s',
+                 self.name, self.host, self.port)
         self.server.serve_forever()
 
     def _value(self, value: str) -> Union[int, str, float]:
@@ -147,54 +376,63 @@ class WebhookDevice(Device):
 
     def event(self, ts: int, value: TValue, retries: int = 0) -> int:
         if self.callback_url is None:
-            log.warning(f'{self.name}: no subscriptions')
+            log.warning('%s: no subscriptions', self.name)
             raise self.EventError('No subscriptions')
 
         # Get event id
-        with self.cursor() as c:
-            res = c.execute("""SELECT id FROM event_id""")
-            row = res.fetchone()
-            if row:
-                event_id = int(row[0]) + 1
-            else:
-                event_id = 1
-            event = {
-                'id': event_id,
-                'time': ts,
-                'value': value,
-            }
-            c.execute("""UPDATE event_id SET id = ?""", (event_id,))
+        event_id = self._insert(SQL_INSERT_SENT_EVENT, (ts, str(value)))
+        event = {
+            'id': event_id,
+            'time': ts,
+            'value': value,
+        }
 
         # Send event
+        attempt = 0
         while True:
             request_error = None
+            retryable = True
             try:
-                res = requests.post(self.callback_url, json=event)
+                res = self._session.post(
+                    self.callback_url,
+                    json=event,
+                    headers={'Idempotency-Key': str(event_id)},
+                    timeout=self.CALLBACK_TIMEOUT,
+                )
                 if not res.ok:
                     request_error = (
                         f'callback returned {res.status_code}:'
                         f' {res.content}'
                     )
+                    # Client errors won't go away on retry
+                    retryable = res.status_code >= 500
             except requests.exceptions.RequestException as err:
                 request_error = str(err)
 
             if request_error is None:
-                log.info('{} Sent event to url'.format(
-                    self.name,
-                    self.callback_url
-                ))
+                self._write(SQL_UPDATE_SENT_AT, (int(time.time()), event_id))
+                log.info('%s Sent event to url %s',
+                         self.name, self.callback_url)
                 return event_id
             else:
-                log.error(f'{self.name} Error sending event: {request_error}')
+                log.error('%s Error sending event: %s',
+                          self.name, request_error)
 
-                if retries == 0:
+                if retries == 0 or not retryable:
                     raise self.EventError(request_error)
 
+                delay = min(
+                    self.RETRY_DELAY_MAX,
+                    self.RETRY_DELAY_BASE * 2 ** attempt,
+                ) * (1 + random.uniform(0, 0.5))
                 log.info(
-                    f'{self.name} Retrying in 5 seconds... '
-                    f'Attempts left: {retries}'
+                    '%s Retrying in %.1f seconds... Attempts left: %s',
+                    self.name,
+                    delay,
+                    retries,
                 )
-                sleep(5)
+                sleep(delay)
+                attempt += 1
                 retries -= 1
 
 
@@ -214,9 +452,17 @@ class CustomEventProtoDevice(Device):
                     value text
                 )
             """)
-            c.execute("""
-                CREATE INDEX IF NOT EXISTS time on events(ts)
+            # Covering index, the serve() query never touches the table
+            c.execute("""DROP INDEX IF EXISTS time""")
+            res = c.execute("""
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'index' AND name = 'idx_events_ts'
             """)
+            if res.fetchone() is None:
+                c.execute("""
+                    CREATE INDEX idx_events_ts ON events(ts, id, value)
+                """)
+                c.execute("""ANALYZE events""")
 
         self.executor_pool = Pool(10)
 
@@ -229,10 +475,15 @@ class CustomEventProtoDevice(Device):
         """ Serve incoming connection """
         try:
             conn.settimeout(3)
+            # Reply goes out in one write, don't let Nagle hold it back, and
+            # give the kernel room to take it without blocking
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             # Read
             try:
                 magic_number = conn.recv(4)
-                if magic_number != b'\xde\xad\xbe\xef':
+                if int.from_bytes(magic_number, 'big') != PROTO_MAGIC:
                     raise self.ProtocolError(
                         f'Wrong magic number from {address}')
 
@@ -243,61 +494,61 @@ class CustomEventProtoDevice(Device):
                     raise self.ProtocolError(f'Wrong term from {address}')
 
             except socket.timeout:
-                log.warning(f'{self.name} Read timeout from {address}')
+                log.warning('%s Read timeout from %s', self.name, address)
                 conn.close()
                 return
 
             except self.ProtocolError as err:
-                log.warning(f'{self.name} {err}')
+                log.warning('%s %s', self.name, err)
                 conn.close()
                 return
 
             # Reply
-            with self.cursor() as c:
-                c.execute(
-                    """
-                        SELECT id, ts, value FROM events 
-                        WHERE time >= ? ORDER BY ts
-                    """,
-                    (timestamp,),
-                )
-                rows = c.fetchall()
-
-                conn.send(b'\xde\xad\xbe\xef')
-                conn.send(len(rows).to_bytes(4, 'big'))
-                for event_id, event_ts, raw_value in rows:
-                    assert isinstance(event_id, int)
-                    assert isinstance(event_ts, int)
-                    value = self._value(raw_value)
-                    conn.send(event_id.to_bytes(8, 'big'))
-                    conn.send(event_ts.to_bytes(8, 'big'))
-                    if isinstance(value, int):
-                        conn.send((8).to_bytes(4, 'big'))
-                        conn.send(value.to_bytes(8, 'big'))
-                    elif isinstance(value, float):
-                        conn.send((8).to_bytes(4, 'big'))
-                        conn.send(bytes(struct.pack('f', value)))
-                    elif isinstance(value, str):
-                        b_value = value.encode('utf8')
-                        conn.send(len(b_value).to_bytes(4, 'big'))
-                        conn.send(b_value)
-                    else:
-                        raise AssertionError('Wrong value type returned')
-                conn.send(b'\0')
-                conn.close()
+            rows = self._read(SQL_SELECT_EVENTS, (timestamp,))
+
+            payloads = []
+            size = _REPLY_HEADER.size + 1
+            for event_id, event_ts, raw_value in rows:
+                assert isinstance(event_id, int)
+                assert isinstance(event_ts, int)
+                value = self._value(raw_value)
+                if isinstance(value, int):
+                    b_value = _INT_VALUE.pack(value)
+                elif isinstance(value, float):
+                    b_value = _FLOAT_VALUE.pack(value)
+                elif isinstance(value, str):
+                    b_value = value.encode('utf8')
+                else:
+                    raise AssertionError('Wrong value type returned')
+                payloads.append((event_id, event_ts, b_value))
+                size += _EVENT_HEADER.size + len(b_value)
+
+            buf = bytearray(size)
+            view = memoryview(buf)
+            _REPLY_HEADER.pack_into(buf, 0, PROTO_MAGIC, len(payloads))
+            offset = _REPLY_HEADER.size
+            for event_id, event_ts, b_value in payloads:
+                _EVENT_HEADER.pack_into(
+                    buf, offset, event_id, event_ts, len(b_value))
+                offset += _EVENT_HEADER.size
+                view[offset:offset + len(b_value)] = b_value
+                offset += len(b_value)
+            # Last byte is the zero terminator
+            conn.sendall(buf)
+            conn.close()
 
         except Exception:
-            log.exception(f'Exception in {self.name} handler for {address}')
+            log.exception('Exception in %s handler for %s', self.name, address)
             conn.close()
             raise
 
     def run(self):
         self.sock.listen()
-        log.info(f'{self.name} listening on {self.host}:{self.port}')
+        log.info('%s listening on %s:%s', self.name, self.host, self.port)
 
         while True:
             connection, client_address = self.sock.accept()
-            log.info(f'{self.name} New connection from {client_address}')
+            log.info('%s New connection from %s', self.name, client_address)
             self.executor_pool.apply_async(
                 self.serve, (connection, client_address))
 
@@ -306,9 +557,4 @@ class CustomEventProtoDevice(Device):
 
     def event(self, ts: int, value: TValue,
               retries: int = 0) -> Optional[int]:
-        with self.cursor() as c:
-            c.execute(
-                """INSERT INTO events (ts, value) VALUES (?, ?)""",
-                (ts, str(value)),
-            )
-            return c.lastrowid
+        return self._insert(SQL_INSERT_EVENT, (ts, str(value)))
@@ -2,13 +2,36 @@
 import json
 import logging
 import os
+import struct
 from gevent import socket
+from gevent.pool import Pool
 from typing import Dict, Any, Optional
 
 from emulator.devices import Device
 
 log = logging.getLogger('emulator.event_socket')
 
+# Binary event frame:
+# <magic:4><ts:8><retries:4><name_len:2><value_len:4><name><value>
+# retries is -1 when not set. Frames not starting with the magic number are
+# read as legacy length-prefixed JSON.
+EVENT_MAGIC = 0xDEADBEEF
+EVENT_HEADER = struct.Struct('>IqiHI')
+MAX_RETRIES = 2 ** 31 - 1
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    """ Read exactly n bytes """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    offset = 0
+    while offset < n:
+        received = sock.recv_into(view[offset:])
+        if not received:
+            raise EOFError(f'Connection closed after {offset}/{n} bytes')
+        offset += received
+    return bytes(buf)
+
 
 class EventSocket:
     def __init__(self, path: str):
@@ -18,65 +41,154 @@ class EventSocket:
     @staticmethod
     def send_dgram(sock: socket.socket, data):
         b_data = json.dumps(data).encode('utf8')
-        sock.send(len(b_data).to_bytes(4, 'big'))
-        sock.send(b_data)
+        sock.sendall(len(b_data).to_bytes(4, 'big') + b_data)
 
     @staticmethod
     def read_dgram(sock: socket.socket) -> Any:
-        b_len = sock.recv(4)
+        b_len = _recv_exact(sock, 4)
         data_len = int.from_bytes(b_len, 'big')
-        data_raw = sock.recv(data_len)
+        data_raw = _recv_exact(sock, data_len)
         return json.loads(data_raw.decode('utf8'))
 
+    @staticmethod
+    def send_event(sock: socket.socket, dev_name: str, ts: int,
+                   value: str, retries: Optional[int] = None):
+        if retries is not None and not 0 <= retries <= MAX_RETRIES:
+            raise ValueError(f'retries must be between 0 and {MAX_RETRIES}')
+        b_name = dev_name.encode('utf8')
+        b_value = value.encode('utf8')
+        header = EVENT_HEADER.pack(
+            EVENT_MAGIC,
+            ts,
+            -1 if retries is None else retries,
+            len(b_name),
+            len(b_value),
+        )
+        sock.sendall(header + b_name + b_value)
 
-class EventSocketClient(EventSocket):
-    def event(self, dev_name: str, ts: int,
-              value: str, retries: Optional[int] = None) -> Optional[int]:
-        try:
-            self.socket.connect(self.socket_path)
-        except OSError as err:
-            log.error(f'Connect to event socket {self.socket_path}: {err}')
-            return
+    @staticmethod
+    def read_event(sock: socket.socket) -> Any:
+        b_head = _recv_exact(sock, 4)
+        if int.from_bytes(b_head, 'big') != EVENT_MAGIC:
+            # Legacy JSON datagram, b_head is its length
+            data_len = int.from_bytes(b_head, 'big')
+            data_raw = _recv_exact(sock, data_len)
+            return json.loads(data_raw.decode('utf8'))
+
+        b_head += _recv_exact(sock, EVENT_HEADER.size - 4)
+        _, ts, retries, name_len, value_len = EVENT_HEADER.unpack(b_head)
+        # Read the whole frame before decoding, so a bad name doesn't leave
+        # the value bytes in the stream
+        b_name = _recv_exact(sock, name_len)
+        b_value = _recv_exact(sock, value_len)
         data = {
-            'dev_name': dev_name,
+            'dev_name': b_name.decode('utf8'),
             'ts': ts,
-            'value': value,
+            'value': b_value.decode('utf8'),
         }
-        if retries is not None:
+        if retries >= 0:
             data['retries'] = retries
-        self.send_dgram(self.socket, data)
+        return data
+
+
+class EventSocketClient(EventSocket):
+    _connected = False
+
+    def connect(self) -> bool:
+        """ Connect once, later events reuse the connection """
+        if not self._connected:
+            try:
+                self.socket.connect(self.socket_path)
+            except OSError as err:
+                log.error('Connect to event socket %s: %s',
+                          self.socket_path, err)
+                return False
+            self._connected = True
+        return True
+
+    def close(self):
+        """ Close the connection, the next event reconnects """
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._connected = False
+
+    def event(self, dev_name: str, ts: int,
+              value: str, retries: Optional[int] = None) -> Optional[int]:
+        reused = self._connected
+        if not self.connect():
+            return
         try:
+            try:
+                self.send_event(self.socket, dev_name, ts, value, retries)
+            except OSError:
+                if not reused:
+                    raise
+                # Server dropped the idle connection, nothing was sent
+                self.close()
+                if not self.connect():
+                    return
+                self.send_event(self.socket, dev_name, ts, value, retries)
             reply = self.read_dgram(self.socket)
-        except json.JSONDecodeError as err:
-            log.error(f'Wrong reply from server: {err}')
+        except (json.JSONDecodeError, EOFError) as err:
+            log.error('Wrong reply from server: %s', err)
+            self.close()
+            return
+        except OSError as err:
+            # Server closed the connection (error reply, busy, restart)
+            log.error('Event socket connection lost: %s', err)
+            self.close()
             return
 
         if 'error' in reply:
-            log.error(f'Server said: {reply["error"]}')
+            log.error('Server said: %s', reply['error'])
             return
 
         if 'id' not in reply or not isinstance(reply['id'], int):
-            log.error(f'Wrong reply from server: {reply}')
+            log.error('Wrong reply from server: %s', reply)
             return
 
         return reply['id']
 
 
 class EventSocketServer(EventSocket):
+    POOL_SIZE = 100
+    # Idle connections are dropped after IDLE_TIMEOUT seconds to free the slot
+    IDLE_TIMEOUT = 30
+
     def __init__(self, path: str, devices: Dict[str, Device]):
         super().__init__(path)
         self.devices = devices
+        self.executor_pool = Pool(self.POOL_SIZE)
 
     def reply_error(self, sock: socket.socket, message: str):
         try:
             self.send_dgram(sock, {'error': message})
         except socket.error as err:
-            log.error(f'Error sending error reply: {err}')
+            log.error('Error sending error reply: %s', err)
 
     def serve(self, sock: socket.socket):
+        """ Serve events from the connection until it's closed """
+        try:
+            sock.settimeout(self.IDLE_TIMEOUT)
+            while self.serve_event(sock):
+                pass
+        finally:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def serve_event(self, sock: socket.socket) -> bool:
+        """ Serve one event, return False when the connection is done """
         # noinspection PyBroadException
         try:
-            data = self.read_dgram(sock)
+            try:
+                data = self.read_event(sock)
+            except (EOFError, socket.timeout):
+                return False
             assert isinstance(data, dict), f'Data is not a dict: {data}'
             assert 'dev_name' in data, f'dev_name not set: {data}'
             assert 'ts' in data, f'ts not set: {data}'
@@ -102,19 +214,16 @@ class EventSocketServer(EventSocket):
                 self.reply_error(sock, str(err))
         except AssertionError as err:
             msg = f'wrong data received: {err}'
-            log.error(f'Event socket: {msg}')
+            log.error('Event socket: %s', msg)
             self.reply_error(sock, msg)
         except ValueError as err:
-            log.warning(f'Event socket: {err}')
+            log.warning('Event socket: %s', err)
             self.reply_error(sock, str(err))
         except Exception as err:
             log.exception('Event socket: exception in serve')
             self.reply_error(sock, f'Internal error: {err}')
-        finally:
-            try:
-                sock.close()
-            except OSError:
-                pass
+            return False
+        return True
 
     def run(self):
         try:
@@ -125,11 +234,17 @@ class EventSocketServer(EventSocket):
         try:
             self.socket.bind(self.socket_path)
         except OSError as err:
-            log.error(f'Listen {self.socket_path}: {err}')
+            log.error('Listen %s: %s', self.socket_path, err)
             return
 
         self.socket.listen()
         log.info('Event socket: listening')
         while True:
             connection, _ = self.socket.accept()
-            self.serve(connection)
+            if self.executor_pool.full():
+                # Don't stall the acceptor behind slow webhook deliveries
+                log.warning('Event socket: all handlers busy')
+                self.reply_error(connection, 'Server busy')
+                connection.close()
+                continue
+            self.executor_pool.apply_async(self.serve, (connection,))
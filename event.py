@@ -4,11 +4,12 @@ import time
 import emulator.patch
 
 import os
+import sys
 import argparse
 import logging
 
 from emulator.common import init
-from emulator.event_socket import EventSocketClient
+from emulator.event_socket import EventSocketClient, MAX_RETRIES
 
 log = logging.getLogger('emulator')
 emulator.patch.noop()
@@ -19,26 +20,54 @@ def pos_int(val):
     val = int(val)
     if val < 0:
         raise argparse.ArgumentTypeError('Positive int required')
+    if val > MAX_RETRIES:
+        raise argparse.ArgumentTypeError(f'Max value is {MAX_RETRIES}')
     return val
 
 
 parser = argparse.ArgumentParser(description='Send event')
 parser.add_argument('--ts', type=int, help='timestamp, default=now')
 parser.add_argument('--retries', type=pos_int, help='retry webhook N times')
-parser.add_argument('device', type=str, help='device name')
-parser.add_argument('value', type=str, help='event value')
+parser.add_argument('--stdin', action='store_true',
+                    help='read "ts device value" lines from stdin and send'
+                         ' them over one connection')
+parser.add_argument('device', type=str, nargs='?', help='device name')
+parser.add_argument('value', type=str, nargs='?', help='event value')
 
 args = parser.parse_args()
+if not args.stdin and (args.device is None or args.value is None):
+    parser.error('device and value are required without --stdin')
 
 config = init(base_path, True)
 event_socket = EventSocketClient(base_path)
-event_id = event_socket.event(
-    dev_name=args.device,
-    ts=args.ts or int(time.time()),
-    value=args.value,
-    retries=args.retries,
-)
-if event_id:
-    log.info(f'Sent event id={event_id}')
+
+
+def send(ts, device, value):
+    event_id = event_socket.event(
+        dev_name=device,
+        ts=ts,
+        value=value,
+        retries=args.retries,
+    )
+    if event_id:
+        log.info(f'Sent event id={event_id}')
+    else:
+        log.info('Failed to send event')
+
+
+if args.stdin:
+    if not event_socket.connect():
+        sys.exit(1)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            ts, device, value = line.split(maxsplit=2)
+            ts = int(ts)
+        except ValueError:
+            log.error(f'Wrong line, need "ts device value": {line.strip()}')
+            continue
+        send(ts, device, value.rstrip('\n'))
 else:
-    log.info('Failed to send event')
+    send(args.ts or int(time.time()), args.device, args.value)
+event_socket.close()